@@ -1,13 +1,30 @@
 """Data loader for DICOM images and associated inner (and optionally outer) masks."""
 
 import logging
+import os
 from os import path
-import csv
-import glob
+import hashlib
+import mmap
+import json
+from itertools import repeat
 import numpy as np
-import random
+import pandas as pd
+import multiprocessing
+import threading
+import queue
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 import parsing
 
+try:
+    import cupy
+except ImportError: # only needed for device 'cuda'
+    cupy = None
+try:
+    from cucim.skimage.draw import polygon2mask
+except ImportError: # only needed for `device_masks`
+    polygon2mask = None
+
 
 class DataLoader(object):
     """Data loader for DICOM images and associated inner (and optionally outer) masks.
@@ -18,6 +35,36 @@ class DataLoader(object):
     Samples are returned in minibatches of size `batch_size`. In each epoch, every sample is read once.
     If the dataset size is not divisible by batch size, samples which would form the last incomplete minibatch
     are skipped in the particular epoch. The dataset is randomly reshuffled before start of each epoch.
+    Samples of a minibatch are loaded concurrently by a pool of `batch_size` threads. If `num_workers` is given,
+    minibatches are prepared ahead in that many background processes, each working on its own shard of the epoch
+    (thus up to `num_workers` incomplete minibatches may be skipped per epoch) and writing to a ring of arrays in
+    shared memory. Otherwise, if `prefetch_thread` is given, minibatches are prepared ahead in a background thread.
+    If `reuse_buffers` is given, minibatches are written to the same arrays in each call of `next()` (with a background
+    thread, to a ring of `prefetch` + 2 sets of arrays), so previous minibatches get overwritten.
+    If `fast_masks` is given, masks are rasterized by code compiled by numba instead of PIL, which is several times
+    faster but may differ from PIL in rare single pixels at sharp corners of contours.
+
+    If `device` is 'cuda', minibatches are returned as CuPy arrays on the GPU. If `device_masks` is also given, masks
+    are rasterized on the GPU by cuCIM, so that only contours need to be copied there; such masks differ from those
+    rasterized on the CPU in border pixels, which cuCIM includes. This is not supported with `num_workers`, `cache`
+    True or `fast_masks`.
+
+    If `pin_memory` is given, minibatch arrays are allocated in page-locked memory (by PyTorch, or CuPy if PyTorch is
+    not installed or cannot allocate it), so that they can be copied to the GPU asynchronously by direct memory access,
+    e.g. by `torch.from_numpy(images).to('cuda', non_blocking=True)`. If neither can allocate it (e.g. without a CUDA
+    driver), ordinary memory is used with a warning. As allocating such memory is slow, it should be used together
+    with `reuse_buffers`. Arrays in shared memory of worker processes are not page-locked.
+
+    If `cache` is given, the list of samples and all samples themselves are loaded once in the constructor and stored
+    in `base_dir/.cache` (the samples in memory-mapped files), which is then read in all epochs (and by later loaders
+    for the same samples). If `cache` is 'contours', only the list of samples and parsed contours are cached
+    (at the first call of `next()`), images are still read from DICOM files and masks rasterized in each epoch.
+    The cache needs to be deleted manually if the data changes.
+
+    Samples are loaded directly into minibatch arrays, whose shape and dtype are given by the first sample loaded.
+    Samples of different size than the first one are skipped. Images can be converted to a smaller `image_dtype`
+    and masks bit-packed along the width axis with `pack_masks` to reduce the size of minibatches; packed masks are
+    unpacked by `np.unpackbits(masks, axis=-1, count=width).view(bool)`.
 
     Example use:
         loader = DataLoader('./final_data', 8) # data is in 'final_data'
@@ -26,22 +73,87 @@ class DataLoader(object):
         loader.reset() # start new epoch by reshuffling the data
     """
 
-    def __init__(self, base_dir, batch_size, both_contours=None, patient_subset=None):
+    def __init__(self, base_dir, batch_size, both_contours=None, patient_subset=None, num_workers=0, prefetch=2,
+                 reuse_buffers=False, cache=False, image_dtype=None, pack_masks=False, prefetch_thread=False,
+                 device='cpu', pin_memory=False, fast_masks=False, device_masks=False):
         """Constructor
 
         :param base_dir: data directory containing 'link.csv' file
         :param batch_size: minibatch size
         :param both_contours: Boolean whether to load samples with both contours only
         :param patient_subset: Optional list of 0-based indexes in 'link.csv' to filtering loading to selected patients
+        :param num_workers: number of background processes preparing minibatches, 0 to load them in `next()`
+        :param prefetch: maximum number of minibatches prepared ahead by the background processes or thread
+        :param reuse_buffers: Boolean whether to return each minibatch in the same (overwritten) arrays
+        :param cache: True to read samples from a cache of preloaded images and masks, 'contours' to cache only
+                      parsed contours, False for no cache
+        :param image_dtype: dtype to convert images to (e.g. np.int16), None to keep the dtype of DICOM data
+        :param pack_masks: Boolean whether to return masks bit-packed along the last axis
+        :param prefetch_thread: Boolean whether to prepare minibatches in a background thread (if `num_workers` is 0)
+        :param device: 'cpu' to return numpy arrays, 'cuda' to return CuPy arrays (needs cupy)
+        :param pin_memory: Boolean whether to allocate minibatch arrays in page-locked memory (needs torch or cupy)
+        :param fast_masks: Boolean whether to rasterize masks by code compiled by numba instead of PIL (needs numba)
+        :param device_masks: Boolean whether to rasterize masks on the GPU by cuCIM with device 'cuda' (needs cucim)
         :return: list of tuples (dicom dir, contour dir)
         """
+        if device not in ('cpu', 'cuda'):
+            raise ValueError('Unknown device: ' + str(device))
+        if device == 'cuda' and pack_masks:
+            raise ValueError("Packed masks are not supported on device 'cuda'")
+        if device_masks and device != 'cuda':
+            raise ValueError("Masks can be rasterized on device 'cuda' only")
+        if device_masks and (num_workers > 0 or cache == True or fast_masks):
+            raise ValueError('Masks rasterized on device are not supported with num_workers, full cache or fast_masks')
+        if device == 'cuda' and cupy is None:
+            raise ImportError("Device 'cuda' needs cupy")
+        if device_masks and polygon2mask is None:
+            raise ImportError('Masks rasterized on device need cucim')
+        if fast_masks and parsing.njit is None:
+            raise ImportError('Fast masks need numba')
+        pinned_backend = self.__pinned_memory_backend() if pin_memory else None
+
         self._base_dir = base_dir
         self._bs = batch_size
         self._both_contours = both_contours == True
         self._pos = 0
+        self._readahead_pos = 0
+        self._pool = ThreadPoolExecutor(max_workers=batch_size)
+        self._num_workers = num_workers
+        self._prefetch = prefetch
+        self._workers = []
+        self._running = 0
+        self._reuse_buffers = reuse_buffers == True
+        self._prefetch_thread = prefetch_thread == True and num_workers == 0
+        # consumer holds one minibatch while the thread fills the queue and builds one more
+        self._num_buffers = prefetch + 2 if self._prefetch_thread else 1
+        self._buffers = []
+        self._buffer_pos = 0
+        self._slots = []
+        self._held_slot = None
+        self._sample_format = None
+        self._image_dtype = image_dtype
+        self._pack_masks = pack_masks == True
+        self._fast_masks = fast_masks == True
 
         patients = self.__read_patients(path.join(self._base_dir, 'link.csv'), patient_subset)
-        self._samples = self.__assemble_samples(patients)
+        samples = self.__cached_samples(patients) if cache else self.__assemble_samples(patients)
+        self._cipaths = np.array([s[0] for s in samples], dtype=object)
+        self._copaths = np.array([s[1] for s in samples], dtype=object)
+        self._dpaths = np.array([s[2] for s in samples], dtype=object)
+        self._order = np.arange(len(samples))
+
+        self._cache_valid = None
+        self._cache_contours = cache == 'contours'
+        self._icoords = self._ocoords = None
+
+        self._device = device
+        self._pinned_backend = pinned_backend
+        self._rasterize_on_device = device_masks == True
+        if device == 'cuda':
+            self._copy_stream = cupy.cuda.Stream(non_blocking=True)
+
+        if cache and not self._cache_contours:
+            self.__open_cache()
 
 
     def __read_patients(self, filename, patient_subset):
@@ -52,17 +164,12 @@ class DataLoader(object):
         :return: list of tuples (dicom dir, contour dir)
         """
 
-        patient_tuples = []
-        i = 0
+        # ids such as 'NA' or 'null' are directory names, not missing values
+        df = pd.read_csv(filename, usecols=['patient_id', 'original_id'], dtype=str, keep_default_na=False)
+        if patient_subset is not None:
+            df = df[np.isin(np.arange(len(df)), list(patient_subset))]
 
-        with open(filename) as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                if patient_subset is None or i in patient_subset:
-                    patient_tuples.append((row['patient_id'], row['original_id']))
-                i = i + 1
-
-        return patient_tuples
+        return list(df[['patient_id', 'original_id']].itertuples(index=False, name=None))
 
 
     def __assemble_samples(self, patient_tuples):
@@ -74,26 +181,77 @@ class DataLoader(object):
                  outer contour filepath is None unless `both_contours` is True
         """
         sample_tuples = []
+        contour_root = path.join(self._base_dir, 'contourfiles')
+        dicom_root = path.join(self._base_dir, 'dicoms')
 
         for did, cid in patient_tuples:
-            icontours_paths = glob.glob(path.join(self._base_dir, 'contourfiles', cid, 'i-contours/*.txt'))
-            for cipath in sorted(icontours_paths):
-                parts = path.basename(cipath).split('-')
+            # filepaths are built by concatenation to directories ending with a separator
+            dicom_dir = path.join(dicom_root, did, '')
+            icontour_dir = path.join(contour_root, cid, 'i-contours', '')
+            ocontour_dir = path.join(contour_root, cid, 'o-contours', '')
+            dicom_names = self.__list_files(dicom_dir)
+            ocontour_names = self.__list_files(ocontour_dir) if self._both_contours else None
+
+            for name in sorted(self.__list_files(icontour_dir)):
+                if not name.endswith('.txt') or name[0] == '.':
+                    continue
+                parts = name.split('-', 3)
                 if parts[0]!='IM' or parts[1]!='0001':
-                    logging.warning('Unknown naming pattern: ' + cipath)
+                    logging.warning('Unknown naming pattern: ' + icontour_dir + name)
+
+                copath = None
+                if self._both_contours:
+                    oname = name.replace('icontour', 'ocontour')
+                    if oname not in ocontour_names:
+                        logging.debug('Missing outer contour: ' + ocontour_dir + oname)
+                        continue
+                    copath = ocontour_dir + oname
+
+                dname = parts[2].lstrip('0') + '.dcm'
+                if dname in dicom_names:
+                    sample_tuples.append((icontour_dir + name, copath, dicom_dir + dname))
+                else:
+                    logging.warning('Non-existing dicom for contour: ' + dicom_dir + dname)
 
-                copath = cipath.replace('icontour', 'ocontour').replace('i-contours', 'o-contours') if self._both_contours else None
-                if copath and not path.isfile(copath):
-                    logging.debug('Missing outer contour: ' + copath)
-                    continue
+        return sample_tuples
 
-                snum = parts[2].lstrip('0')
-                dpath = path.join(self._base_dir, 'dicoms', did, snum + '.dcm')
-                if path.isfile(dpath):
-                    sample_tuples.append((cipath, copath, dpath))
-                else:
-                    logging.warning('Non-existing dicom for contour: ' + dpath)
+    @staticmethod
+    def __list_files(dirname):
+        """Lists files in a directory with a single scan.
 
+        :param dirname: directory path
+        :return: set of filenames, empty if the directory does not exist
+        """
+
+        try:
+            return set(entry.name for entry in os.scandir(dirname) if entry.is_file())
+        except OSError:
+            return set()
+
+    def __cached_samples(self, patient_tuples):
+        """Reads the list of samples from the cache, assembling and storing it first if it does not exist yet.
+
+        :param patient_tuples: list of tuples (dicom dir, contour dir)
+        :return: see `__assemble_samples()`
+        """
+
+        key = hashlib.md5(str((patient_tuples, self._both_contours)).encode('utf-8')).hexdigest()
+        cache_dir = path.join(self._base_dir, '.cache')
+        samples_path = path.join(cache_dir, key + '.samples.json')
+        # filepaths are stored relative to `base_dir`, so that the cache stays valid if it is given differently
+        prefix = path.join(self._base_dir, '')
+
+        if path.isfile(samples_path):
+            with open(samples_path, 'r') as f:
+                return [tuple(prefix + p if p is not None else None for p in s) for s in json.load(f)]
+
+        sample_tuples = self.__assemble_samples(patient_tuples)
+        if not path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = path.join(cache_dir, key + '.samples.tmp.json') # renamed when complete
+        with open(tmp_path, 'w') as f:
+            json.dump([[p[len(prefix):] if p is not None else None for p in s] for s in sample_tuples], f)
+        os.rename(tmp_path, samples_path)
         return sample_tuples
 
     def __load_sample(self, cipath, copath, dpath):
@@ -116,63 +274,630 @@ class DataLoader(object):
         if len(coords_lst) == 0:
             logging.warning('Inner contour file empty: ' + cipath)
             return None, None, None
-        imask = parsing.poly_to_mask(coords_lst, img.shape[1], img.shape[0])
+        imask = parsing.poly_to_mask(coords_lst, img.shape[1], img.shape[0], fast=self._fast_masks)
 
         if copath:
             coords_lst = parsing.parse_contour_file(copath)
             if len(coords_lst) == 0:
                 logging.warning('Outer contour file empty: ' + copath)
                 return None, None, None
-            omask = parsing.poly_to_mask(coords_lst, img.shape[1], img.shape[0])
+            omask = parsing.poly_to_mask(coords_lst, img.shape[1], img.shape[0], fast=self._fast_masks)
         else:
             omask = None
 
         logging.debug('Loaded: ' + dpath)
         return img, imask, omask
 
+    def __load_sample_into(self, i, idx, img_buf, imask_buf, omask_buf):
+        """Loads a sample directly into given arrays, taking contours from the cache if available
+
+        :param i: index in the arrays to write the sample to
+        :param idx: index of the sample
+        :param img_buf: array of images of shape (n, height, width)
+        :param imask_buf: Boolean array of inner masks of shape (n, height, width)
+        :param omask_buf: Boolean array of outer masks of shape (n, height, width), may be None unless `both_contours`
+                          (mask arrays are object arrays of shape (n,) to store contours to if rasterizing on device)
+        :return: True if the sample was loaded, False in case of error
+        """
+
+        cipath, copath, dpath = self._cipaths[idx], self._copaths[idx], self._dpaths[idx]
+
+        try:
+            dcm_dict = parsing.parse_dicom_file(dpath, out=img_buf[i])
+        except parsing.ShapeMismatchError:
+            logging.warning('Sample of different size skipped: ' + dpath)
+            return False
+        if dcm_dict is None:
+            logging.warning('Dicom file invalid: ' + dpath)
+            return False
+        height, width = img_buf.shape[1:]
+
+        coords_lst = self._icoords[idx] if self._icoords is not None else parsing.parse_contour_file(cipath)
+        if len(coords_lst) == 0:
+            logging.warning('Inner contour file empty: ' + cipath)
+            return False
+        if self._rasterize_on_device:
+            imask_buf[i] = coords_lst
+        else:
+            parsing.poly_to_mask(coords_lst, width, height, out=imask_buf[i], fast=self._fast_masks)
+
+        if copath:
+            coords_lst = self._ocoords[idx] if self._ocoords is not None else parsing.parse_contour_file(copath)
+            if len(coords_lst) == 0:
+                logging.warning('Outer contour file empty: ' + copath)
+                return False
+            if self._rasterize_on_device:
+                omask_buf[i] = coords_lst
+            else:
+                parsing.poly_to_mask(coords_lst, width, height, out=omask_buf[i], fast=self._fast_masks)
+
+        logging.debug('Loaded: ' + dpath)
+        return True
+
+    def __load_first_sample(self, idxs):
+        """Loads samples one by one until one succeeds and learns the shape and dtype of samples from it.
+
+        :param idxs: array of sample indexes to try
+        :return: tuple (number of indexes tried, sample), sample being a tuple (image, inner mask, outer mask),
+                 or None if no sample could be loaded
+        """
+
+        for tried, idx in enumerate(idxs, 1):
+            sample = self.__load_sample(self._cipaths[idx], self._copaths[idx], self._dpaths[idx])
+            if sample[0] is not None:
+                self._sample_format = (sample[0].shape, np.dtype(self._image_dtype or sample[0].dtype))
+                return tried, sample
+        return len(idxs), None
+
+    def __cache_dir(self, *extra):
+        """Returns the cache directory for the current list of samples.
+
+        :param extra: further values distinguishing the cache
+        :return: directory path
+        """
+
+        key = [str(s) for s in zip(self._cipaths, self._copaths, self._dpaths)] + [str(e) for e in extra]
+        return path.join(self._base_dir, '.cache', hashlib.md5('\n'.join(key).encode('utf-8')).hexdigest())
+
+    def __open_contour_cache(self):
+        """Reads parsed contours of all samples from the cache, parsing and storing them first if not there yet.
+        """
+
+        cache_dir = self.__cache_dir()
+        contours_path = path.join(cache_dir, 'contours.npz')
+
+        if not path.isfile(contours_path):
+            icoords, ioffsets = self.__parse_contours(self._cipaths)
+            ocoords, ooffsets = self.__parse_contours(self._copaths if self._both_contours else [])
+            if not path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_path = path.join(cache_dir, 'contours.tmp.npz') # renamed when complete
+            np.savez(tmp_path, icoords=icoords, ioffsets=ioffsets, ocoords=ocoords, ooffsets=ooffsets)
+            os.rename(tmp_path, contours_path)
+
+        # plain arrays, so that the file is read without unpickling, split into views of the contours
+        with np.load(contours_path) as contours:
+            self._icoords = np.split(contours['icoords'], contours['ioffsets'][1:-1])
+            self._ocoords = np.split(contours['ocoords'], contours['ooffsets'][1:-1]) if self._both_contours else None
+
+    def __parse_contours(self, paths):
+        """Parses given contour files in parallel.
+
+        :param paths: array of filepaths to contour files
+        :return: tuple (float array of shape (n, 2) holding x, y coordinates of all contours one after another,
+                 int array of len(paths) + 1 offsets of the contours in it)
+        """
+
+        coords = [np.array(coords_lst, dtype=np.float64).reshape(-1, 2)
+                  for coords_lst in self._pool.map(parsing.parse_contour_file, paths)]
+        offsets = np.cumsum([0] + [len(c) for c in coords])
+        return np.concatenate(coords) if coords else np.empty((0, 2)), offsets
+
+    def __open_cache(self):
+        """Opens the memory-mapped cache of all samples, building it first if it does not exist yet.
+        """
+
+        cache_dir = self.__cache_dir(self._image_dtype, self._fast_masks) # masks of both rasterizers may differ
+        meta_path = path.join(cache_dir, 'meta.npz')
+
+        if not path.isfile(meta_path): # meta file is written last, so a missing one means incomplete cache
+            if not self.__build_cache(cache_dir, meta_path):
+                return
+
+        with np.load(meta_path) as meta:
+            shape = (self.size(),) + tuple(meta['shape'])
+            img_dtype, valid = str(meta['img_dtype']), meta['valid']
+        self._imgs_mm = np.memmap(path.join(cache_dir, 'images.memmap'), img_dtype, 'r', shape=shape)
+        self._imasks_mm = np.memmap(path.join(cache_dir, 'imasks.memmap'), np.bool_, 'r', shape=shape)
+        self._omasks_mm = np.memmap(path.join(cache_dir, 'omasks.memmap'), np.bool_, 'r', shape=shape) \
+            if self._both_contours else None
+        self._cache_valid = valid
+        self._sample_format = (shape[1:], self._imgs_mm.dtype)
+        self._order = np.flatnonzero(self._cache_valid) # samples which failed to load were reported when building
+
+    def __build_cache(self, cache_dir, meta_path):
+        """Loads all samples and stores them in memory-mapped files.
+
+        :param cache_dir: directory to store the cache in
+        :param meta_path: filepath to store the shape, dtype and validity of samples to
+        :return: False if no sample could be loaded, True otherwise
+        """
+
+        if not path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        valid = np.zeros(self.size(), np.bool_)
+        tried, sample = self.__load_first_sample(np.arange(self.size()))
+        if sample is None:
+            logging.warning('No sample could be loaded, cache not built')
+            return False
+
+        shape, dtype = self._sample_format
+        shape = (self.size(),) + shape
+        imgs_mm = np.memmap(path.join(cache_dir, 'images.memmap'), dtype, 'w+', shape=shape)
+        imasks_mm = np.memmap(path.join(cache_dir, 'imasks.memmap'), np.bool_, 'w+', shape=shape)
+        omasks_mm = np.memmap(path.join(cache_dir, 'omasks.memmap'), np.bool_, 'w+', shape=shape) \
+            if self._both_contours else None
+
+        imgs_mm[tried - 1], imasks_mm[tried - 1] = sample[:2]
+        if omasks_mm is not None:
+            omasks_mm[tried - 1] = sample[2]
+        valid[tried - 1] = True
+
+        rest = np.arange(tried, self.size())
+        valid[rest] = list(self._pool.map(self.__load_sample_into, rest, rest,
+                                          repeat(imgs_mm), repeat(imasks_mm), repeat(omasks_mm)))
+
+        for mm in (imgs_mm, imasks_mm, omasks_mm):
+            if mm is not None:
+                mm.flush()
+        np.savez(meta_path, valid=valid, shape=np.array(imgs_mm.shape[1:]), img_dtype=imgs_mm.dtype.str)
+        return True
+
     def size(self):
         """Return the number of samples in dataset (though not all may be loaded successfully).
 
         :return: number of samples
         """
 
-        return len(self._samples)
+        return len(self._dpaths)
 
     def next(self):
         """Samples a new minibatch of fixed `batch_size` (given in constructor).
 
         :return: tuple (images, inner masks, outer masks), all numpy arrays of shape (batch_size, height, width),
-                 outer masks is None unless `both_contours` is True.
+                 outer masks is None unless `both_contours` is True. Masks have shape (batch_size, height, ceil(width/8))
+                 if `pack_masks` is given.
                  None if the current epoch is finished or in case of error.
         """
 
-        images = []
-        imasks = []
-        omasks = []
+        if self._cache_contours and self._icoords is None: # before starting workers, so that they inherit it
+            self.__open_contour_cache()
+
+        if self._num_workers > 0 or self._prefetch_thread:
+            return self.__to_device(self.__next_from_workers())
+        return self.__to_device(self.__prepare_batch())
+
+    def __prepare_batch(self):
+        """Loads the next minibatch, either from the cache or the files, and packs its masks if requested.
+
+        :return: see `next()`
+        """
+
+        return self.__pack_masks(self.__build_cached_batch() if self._cache_valid is not None else self.__build_batch())
+
+    def __pack_masks(self, batch):
+        """Packs masks of a minibatch if requested.
+
+        :param batch: minibatch as returned by `next()` without `pack_masks`, may be None
+        :return: see `next()`
+        """
+
+        if batch is None or not self._pack_masks:
+            return batch
+
+        images, imasks, omasks = batch
+        return images, np.packbits(imasks, axis=-1), np.packbits(omasks, axis=-1) if omasks is not None else None
+
+    def __build_batch(self):
+        """Loads the next minibatch of samples in `_order`, starting at `_pos`.
+
+        :return: see `next()`
+        """
+
+        if self._sample_format is None:
+            tried, sample = self.__load_first_sample(self._order[self._pos:])
+            if sample is None: # epoch done
+                self._pos = self._pos + tried
+                return None
+            self._pos = self._pos + tried - 1 # the sample is loaded again, into the minibatch arrays
+
+        images, imasks, omasks = self.__batch_buffers()
+        n = 0
 
-        while len(images) != self._bs:
-            if self._pos >= len(self._samples): # epoch done
-                if len(images) > 0:
+        while n != self._bs:
+            if self._pos >= len(self._order): # epoch done
+                if n > 0:
                     logging.info('Incomplete batch skipped')
                 return None
 
-            img, imask, omask = self.__load_sample(*self._samples[self._pos])
-            self._pos = self._pos + 1
-            if img is None: # move over incorrectly read samples
+            # load just the missing samples in parallel, another round is needed only if some of them failed
+            window = self._order[self._pos:self._pos + self._bs - n]
+            # the kernel reads DICOM files of the following minibatch ahead, while samples are parsed (the files of
+            # this one were advised with the previous minibatch, except at the start of an epoch)
+            start = max(self._readahead_pos, self._pos)
+            self._readahead_pos = self._pos + len(window) + self._bs
+            self.__prefetch_paths(self._dpaths[self._order[start:self._readahead_pos]])
+            self._pos = self._pos + len(window)
+            slots = np.arange(n, n + len(window))
+            loaded = list(self._pool.map(self.__load_sample_into, slots, window,
+                                         repeat(images), repeat(imasks), repeat(omasks)))
+
+            if all(loaded): # usual case, no gaps to close
+                n = n + len(window)
                 continue
 
-            images.append(img)
-            imasks.append(imask)
-            omasks.append(omask)
+            bufs = (images, imasks) if omasks is None else (images, imasks, omasks)
+            for slot, ok in zip(slots, loaded):
+                if not ok: # move over incorrectly read samples
+                    continue
 
-        try:
-            return np.stack(images), np.stack(imasks), np.stack(omasks) if self._both_contours else None
-        except ValueError:
-            logging.error('Batch consisted of samples of different size')
+                if slot != n: # close the gap left by samples which failed
+                    for buf in bufs:
+                        buf[n] = buf[slot]
+                n = n + 1
+
+        return images, imasks, omasks
+
+    def __build_cached_batch(self):
+        """Reads the next minibatch of samples in `_order` from the cache, starting at `_pos`.
+
+        :return: see `next()`
+        """
+
+        idxs = self._order[self._pos:self._pos + self._bs]
+        self._pos = self._pos + len(idxs)
+        if len(idxs) != self._bs: # epoch done
+            if len(idxs) > 0:
+                logging.info('Incomplete batch skipped')
             return None
 
+        images, imasks, omasks = self.__batch_buffers()
+        np.take(self._imgs_mm, idxs, axis=0, out=images)
+        np.take(self._imasks_mm, idxs, axis=0, out=imasks)
+        if omasks is not None:
+            np.take(self._omasks_mm, idxs, axis=0, out=omasks)
+        return images, imasks, omasks
+
+    @staticmethod
+    def __prefetch_paths(paths):
+        """Asks the kernel to read given files into the page cache in the background (where supported).
+
+        :param paths: filepaths
+        """
+
+        if not hasattr(os, 'posix_fadvise'):
+            return
+
+        for filename in paths:
+            try:
+                fd = os.open(filename, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+
+    def __batch_buffers(self):
+        """Allocates arrays for a minibatch of samples of the learnt shape and dtype, or reuses the previous ones.
+
+        :return: tuple (images, inner masks, outer masks), uninitialized numpy arrays of shape (batch_size, height, width),
+                 outer masks is None unless `both_contours` is True.
+        """
+
+        if self._reuse_buffers and len(self._buffers) == self._num_buffers:
+            self._buffer_pos = (self._buffer_pos + 1) % self._num_buffers
+            return self._buffers[self._buffer_pos]
+
+        shape, dtype = self._sample_format
+        shape = (self._bs,) + shape
+        empty = self.__pinned_empty if self._pinned_backend is not None else np.empty
+        img_buf = empty(shape, dtype)
+        # contours are kept instead of masks if rasterizing on device
+        if self._rasterize_on_device:
+            imask_buf = np.empty(self._bs, object)
+            omask_buf = np.empty(self._bs, object) if self._both_contours else None
+        else:
+            imask_buf = empty(shape, np.bool_)
+            omask_buf = empty(shape, np.bool_) if self._both_contours else None
+        if self._reuse_buffers:
+            self._buffers.append((img_buf, imask_buf, omask_buf))
+            self._buffer_pos = len(self._buffers) - 1
+        return img_buf, imask_buf, omask_buf
+
+    @staticmethod
+    def __pinned_memory_backend():
+        """Finds a library which can allocate page-locked memory on this machine, PyTorch preferred over CuPy.
+
+        :return: 'torch' or 'cupy', None if neither of them can (e.g. without a CUDA driver)
+        """
+
+        installed = False
+        try:
+            import torch
+            installed = True
+            torch.empty(1, dtype=torch.uint8, pin_memory=True)
+            return 'torch'
+        except ImportError:
+            pass
+        except RuntimeError as e:
+            logging.warning('PyTorch cannot allocate page-locked memory: ' + str(e))
+        try:
+            import cupy
+            installed = True
+            cupy.cuda.alloc_pinned_memory(1)
+            return 'cupy'
+        except ImportError:
+            pass
+        except RuntimeError as e: # also CUDA errors of CuPy
+            logging.warning('CuPy cannot allocate page-locked memory: ' + str(e))
+
+        if not installed:
+            raise ImportError('Page-locked memory needs torch or cupy')
+        logging.warning('Page-locked memory not available, minibatch arrays are allocated in ordinary memory')
+        return None
+
+    def __pinned_empty(self, shape, dtype):
+        """Allocates an uninitialized array in page-locked memory.
+
+        :param shape: shape of the array
+        :param dtype: dtype of the array
+        :return: numpy array
+        """
+
+        count = int(np.prod(shape))
+        nbytes = count * np.dtype(dtype).itemsize
+        if self._pinned_backend == 'torch':
+            import torch
+            buf = torch.empty(nbytes, dtype=torch.uint8, pin_memory=True).numpy()
+        else:
+            import cupy
+            buf = cupy.cuda.alloc_pinned_memory(nbytes)
+        return np.frombuffer(buf, np.uint8, nbytes).view(dtype).reshape(shape)
+
+    def __to_device(self, batch):
+        """Copies a minibatch to the GPU if `device` is 'cuda', rasterizing its masks there if needed.
+
+        :param batch: minibatch as returned by `next()` for device 'cpu' (but with contours instead of masks
+                      if rasterizing on device), may be None
+        :return: see `next()`
+        """
+
+        if batch is None or self._device == 'cpu':
+            return batch
+
+        images, imasks, omasks = batch
+        # asynchronous for page-locked host memory, the arrays are allocated on the stream they are filled on
+        with self._copy_stream:
+            d_images = cupy.empty(images.shape, images.dtype)
+            d_images.set(images)
+            if not self._rasterize_on_device:
+                d_masks = [cupy.asarray(masks) if masks is not None else None for masks in (imasks, omasks)]
+
+        if self._rasterize_on_device: # overlaps with the copy of images
+            d_masks = [self.__rasterize_on_device(masks, images.shape[1:]) if masks is not None else None
+                       for masks in (imasks, omasks)]
+
+        self._copy_stream.synchronize()
+        return d_images, d_masks[0], d_masks[1]
+
+    @staticmethod
+    def __rasterize_on_device(contours, shape):
+        """Rasterizes contours on the GPU.
+
+        :param contours: object array of contours as lists of pairs of x, y coords or float arrays of shape (n, 2)
+        :param shape: shape of masks (height, width)
+        :return: Boolean CuPy array of masks of shape (len(contours), height, width)
+        """
+
+        masks = cupy.empty((len(contours),) + shape, dtype=cupy.bool_)
+        for i, coords in enumerate(contours):
+            coords = np.asarray(coords, dtype=np.float64)[:, ::-1] # cuCIM takes (row, column) coords
+            masks[i] = polygon2mask(shape, cupy.asarray(coords))
+        return masks
+
+    def __shared_buffers(self):
+        """Allocates arrays for a minibatch of samples of the learnt shape and dtype in memory shared with forked
+        worker processes.
+
+        :return: tuple (images, inner masks, outer masks), see `__batch_buffers()`
+        """
+
+        shape, dtype = self._sample_format
+        shape = (self._bs,) + shape
+        count = int(np.prod(shape))
+        img_bytes = count * np.dtype(dtype).itemsize
+
+        buf = mmap.mmap(-1, img_bytes + count * (2 if self._both_contours else 1)) # anonymous, shared on fork
+        img_buf = np.frombuffer(buf, dtype, count).reshape(shape)
+        imask_buf = np.frombuffer(buf, np.bool_, count, img_bytes).reshape(shape)
+        omask_buf = np.frombuffer(buf, np.bool_, count, img_bytes + count).reshape(shape) \
+            if self._both_contours else None
+        return img_buf, imask_buf, omask_buf
+
+    def __start_workers(self):
+        """Splits the rest of the epoch into shards of whole minibatches and forks a worker process for each shard,
+        or starts a single background thread continuing from `_pos` if there are no worker processes.
+        """
+
+        if self._num_workers > 0:
+            rest = self._order[self._pos:]
+            chunk_ids = np.arange(len(rest)) // self._bs
+            self._pos = len(self._order)
+
+            if self._sample_format is None: # needed to allocate the shared arrays, the sample is loaded again later
+                self.__load_first_sample(rest)
+                if self._sample_format is None:
+                    return
+            # each worker fills one slot, up to `prefetch` slots are queued and one is held by the consumer
+            if not self._slots:
+                self._slots = [self.__shared_buffers() for _ in range(self._num_workers + self._prefetch + 1)]
+
+            # fork, so that the loader itself does not need to be pickled
+            ctx = multiprocessing.get_context('fork')
+            self._queue = ctx.Queue(maxsize=self._prefetch)
+            self._free_slots = ctx.Queue()
+            for slot in range(len(self._slots)):
+                self._free_slots.put(slot)
+            self._stop = ctx.Event()
+            self._workers = [ctx.Process(target=self.__worker_loop, args=(rest[chunk_ids % self._num_workers == w],))
+                             for w in range(self._num_workers)]
+        else:
+            self._queue = queue.Queue(maxsize=self._prefetch)
+            self._stop = threading.Event()
+            self._workers = [threading.Thread(target=self.__worker_loop)]
+
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+        self._running = len(self._workers)
+
+    def __worker_loop(self, shard=None):
+        """Body of a worker process or thread, puts minibatches (or shared slots they were written to in the case
+        of worker processes) to the queue followed by None. A worker which fails puts the exception before the None
+        (its traceback as a string in the case of worker processes).
+
+        :param shard: array of sample indexes to process in a worker process, None in the background thread
+        """
+
+        if shard is not None:
+            # threads of the parent's pool did not survive the fork
+            self._pool = ThreadPoolExecutor(max_workers=self._bs)
+            self._order = shard
+            self._pos = self._readahead_pos = 0
+            # minibatches are built in the slot taken from the free ones
+            self._reuse_buffers = True
+            self._num_buffers = 1
+
+            try:
+                while not self._stop.is_set():
+                    slot = self._free_slots.get()
+                    self._buffers = [self._slots[slot]]
+                    batch = self.__build_cached_batch() if self._cache_valid is not None else self.__build_batch()
+                    if batch is None:
+                        self._free_slots.put(slot)
+                        break
+                    self._queue.put(slot)
+            except Exception:
+                self._queue.put('Worker process failed:\n' + traceback.format_exc()) # raised by the consumer
+            self._queue.put(None)
+            return
+
+        try:
+            while not self._stop.is_set():
+                batch = self.__prepare_batch()
+                if batch is None:
+                    break
+                self._queue.put(batch)
+        except Exception as e:
+            self._queue.put(e) # raised by the consumer
+        self._queue.put(None)
+
+    def __next_from_workers(self):
+        """Takes the next minibatch prepared by worker processes or thread, starting them if necessary.
+
+        :return: see `next()`
+        """
+
+        if not self._workers:
+            self.__start_workers()
+        self.__release_slot()
+
+        while self._running > 0:
+            item = self.__get_from_workers()
+            if item is None:
+                self._running = self._running - 1
+            elif isinstance(item, str):
+                raise RuntimeError(item)
+            elif isinstance(item, Exception):
+                raise item
+            elif self._num_workers == 0:
+                return item
+            else:
+                return self.__take_slot(item)
+        return None
+
+    def __get_from_workers(self):
+        """Takes the next item from the queue of worker processes or thread, checking that worker processes are
+        still alive while waiting for it.
+
+        :return: minibatch (from the thread), index of a shared slot (from worker processes), None when a worker
+                 finished, or the exception of the thread or a string describing the failure of a worker process
+        """
+
+        if self._num_workers == 0:
+            return self._queue.get()
+
+        while True:
+            try:
+                return self._queue.get(timeout=1.0)
+            except queue.Empty:
+                pass
+            # a killed worker (e.g. by the OOM killer) never puts its None, the others put everything before exiting
+            alive = sum(worker.is_alive() for worker in self._workers)
+            if alive < self._running and self._queue.empty():
+                exitcodes = [worker.exitcode for worker in self._workers if worker.exitcode]
+                self._running = alive
+                return 'Worker process died, exit codes: ' + str(exitcodes)
+
+    def __take_slot(self, slot):
+        """Turns a shared slot filled by a worker process into a minibatch. The slot is held until the next call of
+        `next()` if `reuse_buffers` is given, otherwise the minibatch is copied out and the slot released at once.
+
+        :param slot: index of the slot
+        :return: see `next()`
+        """
+
+        batch = self.__pack_masks(self._slots[slot])
+        if self._reuse_buffers:
+            self._held_slot = slot
+            return batch
+
+        batch = tuple(a.copy() if a is not None else None for a in batch)
+        self._free_slots.put(slot)
+        return batch
+
+    def __release_slot(self):
+        """Gives the shared slot held by the consumer back to worker processes.
+        """
+
+        if self._held_slot is not None:
+            self._free_slots.put(self._held_slot)
+            self._held_slot = None
+
+    def __stop_workers(self):
+        """Stops worker processes or thread, draining the queue so that none of them stays blocked on it.
+        """
+
+        if not self._workers:
+            return
+
+        self._stop.set()
+        self.__release_slot()
+        while self._running > 0:
+            item = self.__get_from_workers()
+            if item is None:
+                self._running = self._running - 1
+            elif self._num_workers > 0 and not isinstance(item, str): # workers may be waiting for a free slot
+                self._free_slots.put(item)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
     def reset(self):
         """Starts a new epoch by reshuffling the dataset.
         """
-        random.shuffle(self._samples)
-        self._pos = 0
+        self.__stop_workers()
+        np.random.shuffle(self._order)
+        self._pos = self._readahead_pos = 0
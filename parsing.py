@@ -1,11 +1,33 @@
 """Parsing code for DICOMS and contour files"""
 
-import dicom
-from dicom.errors import InvalidDicomError
-
 import numpy as np
 from PIL import Image, ImageDraw
 
+try:
+    from numba import njit
+except ImportError: # numba is optional, only needed for poly_to_mask(fast=True)
+    njit = None
+
+# elements needed to decode and rescale pixel data, the rest of the header is skipped where supported
+PIXEL_TAGS = ['SamplesPerPixel', 'PhotometricInterpretation', 'PlanarConfiguration', 'NumberOfFrames',
+              'Rows', 'Columns', 'BitsAllocated', 'BitsStored', 'HighBit', 'PixelRepresentation',
+              'RescaleIntercept', 'RescaleSlope', 'PixelData']
+
+try:
+    import pydicom as dicom
+    from pydicom.errors import InvalidDicomError
+    _read_dicom = dicom.dcmread
+    _read_dicom_kwargs = {'specific_tags': PIXEL_TAGS}
+except ImportError: # pydicom < 1.0 can only read the full header
+    import dicom
+    from dicom.errors import InvalidDicomError
+    _read_dicom = dicom.read_file
+    _read_dicom_kwargs = {}
+
+
+class ShapeMismatchError(ValueError):
+    """Raised by `parse_dicom_file()` if the image does not fit into the given array."""
+
 
 def parse_contour_file(filename):
     """Parse the given contour filename
@@ -27,16 +49,22 @@ def parse_contour_file(filename):
     return coords_lst
 
 
-def parse_dicom_file(filename):
+def parse_dicom_file(filename, out=None):
     """Parse the given DICOM filename
 
     :param filename: filepath to the DICOM file to parse
-    :return: dictionary with DICOM image data
+    :param out: optional array of the image shape to write the (rescaled) image to,
+     ShapeMismatchError is raised if the shape does not match
+    :return: dictionary with DICOM image data, the dataset 'dcm' contains only `PIXEL_TAGS` if pydicom >= 1.0,
+     None if the file is not a valid DICOM file or its pixel data cannot be decoded
     """
 
     try:
-        dcm = dicom.read_file(filename)
-        dcm_image = dcm.pixel_array
+        dcm = _read_dicom(filename, **_read_dicom_kwargs)
+        try:
+            dcm_image = dcm.pixel_array
+        except ValueError: # e.g. truncated pixel data
+            return None
 
         try:
             intercept = dcm.RescaleIntercept
@@ -47,26 +75,139 @@ def parse_dicom_file(filename):
         except AttributeError:
             slope = 0.0
 
+        if out is not None and out.shape != dcm_image.shape:
+            raise ShapeMismatchError('Image of shape {} cannot be written to array of shape {}'.format(
+                dcm_image.shape, out.shape))
+
         if intercept != 0.0 and slope != 0.0:
-            dcm_image = dcm_image*slope + intercept
+            if out is None:
+                dcm_image = dcm_image*slope + intercept
+            elif np.issubdtype(out.dtype, np.floating): # rescale in place instead of in temporary arrays
+                np.multiply(dcm_image, slope, out=out)
+                np.add(out, intercept, out=out)
+                dcm_image = out
+            else: # integer arrays would truncate the intermediate product, so it is computed in float
+                out[...] = dcm_image*slope + intercept
+                dcm_image = out
+        elif out is not None:
+            out[...] = dcm_image
+            dcm_image = out
         dcm_dict = {'pixel_data' : dcm_image, 'dcm': dcm}
         return dcm_dict
     except InvalidDicomError:
         return None
 
 
-def poly_to_mask(polygon, width, height):
+def fill_polygon(coords, out):
+    """Rasterize polygon like `ImageDraw.polygon(outline=0, fill=1)`: vertices are truncated to integers, rows are
+    scanline filled (even-odd rule) and the outline is cleared again. Masks of simple polygons match those drawn by PIL
+    except for rare single pixels at sharp corners, where PIL applies further rules.
+
+    :param coords: float array of shape (n, 2) holding x, y coords of polygon vertices in units of pixels
+    :param out: Boolean array of shape (height, width) to write the mask to
+    :return: `out`
+    """
+
+    height, width = out.shape
+    n = coords.shape[0]
+    xs = np.empty(n)
+    ixy = np.empty((n, 2), dtype=np.int64)
+    for i in range(n):
+        ixy[i, 0] = int(coords[i, 0])
+        ixy[i, 1] = int(coords[i, 1])
+
+    for y in range(height):
+        out[y, :] = False
+
+        # intersections of the scanline with edges, each edge is half-open in y so that vertices count once
+        k = 0
+        for i in range(n):
+            x0, y0 = ixy[i, 0], ixy[i, 1]
+            x1, y1 = ixy[(i + 1) % n, 0], ixy[(i + 1) % n, 1]
+            if y0 == y1:
+                if y0 == y: # horizontal edges are filled as a whole
+                    for x in range(max(min(x0, x1), 0), min(max(x0, x1), width - 1) + 1):
+                        out[y, x] = True
+            elif y0 <= y < y1 or y1 <= y < y0:
+                xs[k] = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+                k += 1
+
+        row_xs = np.sort(xs[:k])
+        for j in range(0, k - 1, 2):
+            start = max(int(np.ceil(row_xs[j])), 0)
+            end = min(int(np.floor(row_xs[j + 1])), width - 1)
+            for x in range(start, end + 1):
+                out[y, x] = True
+
+    # the outline is cleared by Bresenham's algorithm with PIL's rounding, each edge excludes its last pixel
+    for i in range(n):
+        x, y = ixy[i, 0], ixy[i, 1]
+        dx, dy = ixy[(i + 1) % n, 0] - x, ixy[(i + 1) % n, 1] - y
+        sx = -1 if dx < 0 else 1
+        sy = -1 if dy < 0 else 1
+        dx, dy = abs(dx), abs(dy)
+        steps = max(dx, dy)
+        e = 2 * dy - dx if dx > dy else 2 * dx - dy
+        for _ in range(steps):
+            if 0 <= x < width and 0 <= y < height:
+                out[y, x] = False
+            if dx > dy:
+                if e >= 0:
+                    y += sy
+                    e -= 2 * dx
+                e += 2 * dy
+                x += sx
+            else:
+                if e >= 0:
+                    x += sx
+                    e -= 2 * dy
+                e += 2 * dx
+                y += sy
+
+    return out
+
+
+if njit is not None:
+    # nogil, as masks of a minibatch are rasterized concurrently by the data loader's threads
+    fill_polygon = njit(cache=True, nogil=True)(fill_polygon)
+    fill_polygon(np.zeros((3, 2)), np.zeros((1, 1), dtype=np.bool_)) # compile at import time
+
+
+def poly_to_mask(polygon, width, height, out=None, fast=False):
     """Convert polygon to mask
 
     :param polygon: list of pairs of x, y coords [(x1, y1), (x2, y2), ...]
-     in units of pixels
+     or float array of shape (n, 2), in units of pixels
     :param width: scalar image width
     :param height: scalar image height
-    :return: Boolean mask of shape (height, width)
+    :param out: optional Boolean array of shape (height, width) to write the mask to
+    :param fast: Boolean whether to rasterize by `fill_polygon()` compiled by numba instead of PIL (needs numba)
+    :return: Boolean mask of shape (height, width), `out` if given
     """
 
+    if fast:
+        if njit is None:
+            raise ImportError('Fast rasterization needs numba')
+        if out is None:
+            out = np.empty((height, width), dtype=np.bool_)
+        return fill_polygon(np.asarray(polygon, dtype=np.float64).reshape(-1, 2), out)
+
+    if isinstance(polygon, np.ndarray):
+        polygon = [tuple(p) for p in polygon.tolist()]
+
+    # the image is drawn directly into the (writable) mask, it holds only 0s and 1s, which are valid Booleans
+    if out is not None and out.flags.c_contiguous:
+        mask = out
+    else:
+        mask = np.empty((height, width), dtype=np.bool_)
+    mask[...] = False
+    img = Image.frombuffer('L', (width, height), mask.view(np.uint8), 'raw', 'L', 0, 1)
+    img.readonly = 0 # frombuffer() images are read-only, but the buffer is owned by the mask
+
     # http://stackoverflow.com/a/3732128/1410871
-    img = Image.new(mode='L', size=(width, height), color=0)
     ImageDraw.Draw(img).polygon(xy=polygon, outline=0, fill=1)
-    mask = np.array(img).astype(bool)
-    return mask
+
+    if out is None or mask is out:
+        return mask
+    out[...] = mask
+    return out
@@ -1,8 +1,15 @@
 """Unit test for DataLoader (public methods only)"""
 
 import unittest
+import glob
+import importlib.util
+import os
+import shutil
+import tempfile
+from os import path
 import numpy as np
 
+import parsing
 from dataloader import DataLoader
 
 class TestDataLoader(unittest.TestCase):
@@ -16,6 +23,23 @@ class TestDataLoader(unittest.TestCase):
         dl = DataLoader('./test_data', 2, True)
         self.assertTrue(dl.size() == 1)
 
+    def test_size_patient_subset(self):
+        """Test DataLoader.size() with a subset of patients """
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            base_dir = path.join(tmp_dir, 'test_data')
+            shutil.copytree('./test_data', base_dir)
+            os.rename(path.join(base_dir, 'dicoms', 'dicom1'), path.join(base_dir, 'dicoms', 'NA'))
+            with open(path.join(base_dir, 'link.csv'), 'w') as f:
+                f.write('patient_id,original_id\nmissing,folder1\nNA,folder1\n')
+
+            self.assertTrue(DataLoader(base_dir, 2, patient_subset=[1]).size() == 4)
+            self.assertTrue(DataLoader(base_dir, 2, patient_subset=[0]).size() == 0)
+            self.assertTrue(DataLoader(base_dir, 2, patient_subset=[]).size() == 0)
+        finally:
+            shutil.rmtree(tmp_dir)
+
     def test_next(self):
         """Test DataLoader.next() """
 
@@ -32,6 +56,46 @@ class TestDataLoader(unittest.TestCase):
         n_unique_imgs = np.unique([np.sum(i1[0]), np.sum(i1[1]), np.sum(i2[0]), np.sum(i2[1])])
         self.assertTrue(len(n_unique_imgs) == 4)
         
+    def test_next_invalid_sample(self):
+        """Test DataLoader.next() replacing a sample which failed to load """
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            base_dir = path.join(tmp_dir, 'test_data')
+            shutil.copytree('./test_data', base_dir)
+            with open(path.join(base_dir, 'dicoms', 'dicom1', '148.dcm'), 'wb') as f:
+                f.write(b'not a dicom')
+
+            # the invalid sample is replaced by the remaining one, so there is one full minibatch
+            dl = DataLoader(base_dir, 3)
+            i1, mi1, mo1 = dl.next()
+            self.assertTrue(i1.shape == (3,256,256) and mi1.shape == (3,256,256) and mo1 == None)
+            n_unique_imgs = np.unique([np.sum(i1[0]), np.sum(i1[1]), np.sum(i1[2])])
+            self.assertTrue(len(n_unique_imgs) == 3)
+            self.assertTrue(dl.next() is None)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_next_truncated_sample(self):
+        """Test DataLoader.next() skipping a sample with truncated pixel data, also as the first sample loaded """
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            base_dir = path.join(tmp_dir, 'test_data')
+            shutil.copytree('./test_data', base_dir)
+            filename = path.join(base_dir, 'dicoms', 'dicom1', '68.dcm')
+            dcm = parsing.parse_dicom_file(filename)['dcm']
+            dcm.PixelData = dcm.PixelData[:1000]
+            dcm.save_as(filename)
+
+            for cache in (False, True):
+                dl = DataLoader(base_dir, 3, cache=cache)
+                i1, mi1, _ = dl.next()
+                self.assertTrue(i1.shape == (3,256,256) and mi1.shape == (3,256,256))
+                self.assertTrue(dl.next() is None)
+        finally:
+            shutil.rmtree(tmp_dir)
+
     def test_next_inout_contour(self):
         """Test DataLoader.next(), inner and outer contours """
 
@@ -42,6 +106,224 @@ class TestDataLoader(unittest.TestCase):
         self.assertTrue(i1.shape == (1,256,256) and mi1.shape == (1,256,256) and mo1.shape == (1,256,256))
         self.assertTrue(np.linalg.norm(mi1-mo1) != 0)     
 
+    def test_next_reuse_buffers(self):
+        """Test DataLoader.next() returning minibatches in reused arrays """
+
+        dl = DataLoader('./test_data', 2, reuse_buffers=True)
+
+        i1, mi1, _ = dl.next()
+        s1 = np.sum(i1)
+        i2, mi2, _ = dl.next()
+        self.assertTrue(i1 is i2 and mi1 is mi2)
+        self.assertTrue(i2.shape == (2,256,256) and np.sum(i2) != s1)
+
+    def test_next_dtypes(self):
+        """Test DataLoader.next() with converted images and packed masks """
+
+        i1, mi1, mo1 = DataLoader('./test_data', 1, True).next()
+        i2, mi2, mo2 = DataLoader('./test_data', 1, True, image_dtype=np.int16, pack_masks=True).next()
+
+        self.assertTrue(i2.dtype == np.int16 and np.array_equal(i1, i2))
+        self.assertTrue(mi2.dtype == np.uint8 and mi2.shape == (1,256,32) and mo2.shape == (1,256,32))
+        self.assertTrue(np.array_equal(np.unpackbits(mi2, axis=-1).view(bool), mi1))
+        self.assertTrue(np.array_equal(np.unpackbits(mo2, axis=-1).view(bool), mo1))
+
+    @unittest.skipIf(parsing.njit is None, 'needs numba')
+    def test_next_fast_masks(self):
+        """Test DataLoader.next() with masks rasterized by numba """
+
+        # masks of each image (identified by its sum) are the same as rasterized by PIL
+        masks = {}
+        for fast_masks in (False, True):
+            dl = DataLoader('./test_data', 2, fast_masks=fast_masks)
+            for i, mi, _ in iter(dl.next, None):
+                for img, mask in zip(i, mi):
+                    masks.setdefault(np.sum(img), []).append(mask.copy())
+        self.assertTrue(len(masks) == 4)
+        for pil_mask, fast_mask in masks.values():
+            self.assertTrue(np.array_equal(pil_mask, fast_mask))
+
+    @unittest.skipIf(parsing.njit is None, 'needs numba')
+    def test_next_cache_fast_masks(self):
+        """Test DataLoader.next() reading masks rasterized by numba from a separate cache """
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            base_dir = path.join(tmp_dir, 'test_data')
+            shutil.copytree('./test_data', base_dir)
+            for fast_masks in (False, True):
+                DataLoader(base_dir, 2, cache=True, fast_masks=fast_masks).next()
+            cache_files = glob.glob(path.join(base_dir, '.cache', '*', 'meta.npz'))
+            self.assertTrue(len(cache_files) == 2)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_next_pin_memory(self):
+        """Test DataLoader.next() with arrays in page-locked memory """
+
+        # without torch or cupy, the loader cannot be constructed, without CUDA, it falls back to ordinary memory
+        if importlib.util.find_spec('torch') is None and importlib.util.find_spec('cupy') is None:
+            with self.assertRaises(ImportError):
+                DataLoader('./test_data', 2, pin_memory=True)
+            return
+
+        dl = DataLoader('./test_data', 2, reuse_buffers=True, pin_memory=True)
+        batches = [tuple(a.copy() if a is not None else None for a in b) for b in iter(dl.next, None)]
+        self.assertTrue(len(batches) == 2)
+        for i, mi, mo in batches:
+            self.assertTrue(i.shape == (2,256,256) and mi.shape == (2,256,256) and mo is None)
+        n_unique_imgs = np.unique([np.sum(img) for i, _, _ in batches for img in i])
+        self.assertTrue(len(n_unique_imgs) == 4)
+
+    def test_init_device(self):
+        """Test DataLoader() checking the device options """
+
+        with self.assertRaises(ValueError):
+            DataLoader('./test_data', 2, device='gpu')
+        with self.assertRaises(ValueError):
+            DataLoader('./test_data', 2, device='cuda', pack_masks=True)
+        with self.assertRaises(ValueError):
+            DataLoader('./test_data', 2, device_masks=True)
+        with self.assertRaises(ValueError):
+            DataLoader('./test_data', 2, num_workers=2, device='cuda', device_masks=True)
+        if importlib.util.find_spec('cupy') is None:
+            with self.assertRaises(ImportError):
+                DataLoader('./test_data', 2, device='cuda')
+
+    def test_next_workers(self):
+        """Test DataLoader.next() with background worker processes """
+
+        dl = DataLoader('./test_data', 2, num_workers=2)
+
+        # both minibatches are properly sized
+        batches = list(iter(dl.next, None))
+        self.assertTrue(len(batches) == 2)
+        for i, mi, mo in batches:
+            self.assertTrue(i.shape == (2,256,256) and mi.shape == (2,256,256) and mo == None)
+
+        # all 4 images were returned in the minibatches, also in the next epoch
+        n_unique_imgs = np.unique([np.sum(img) for i, _, _ in batches for img in i])
+        self.assertTrue(len(n_unique_imgs) == 4)
+        dl.reset()
+        self.assertTrue(len(list(iter(dl.next, None))) == 2)
+
+    def test_next_workers_error(self):
+        """Test DataLoader.next() with a background worker process failing """
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            base_dir = path.join(tmp_dir, 'test_data')
+            shutil.copytree('./test_data', base_dir)
+            dl = DataLoader(base_dir, 1, num_workers=2)
+            os.remove(path.join(base_dir, 'contourfiles', 'folder1', 'i-contours', 'IM-0001-0179-icontour-manual.txt'))
+
+            # the error of the worker is raised instead of waiting for its minibatches forever
+            with self.assertRaises(RuntimeError):
+                while dl.next() is not None:
+                    pass
+            dl.reset()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_next_cache(self):
+        """Test DataLoader.next() reading from the cache """
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            base_dir = path.join(tmp_dir, 'test_data')
+            shutil.copytree('./test_data', base_dir)
+            i1, mi1, mo1 = DataLoader(base_dir, 1, True).next()
+
+            # the cache is built by the first loader and read by the second one, both give the same samples
+            for cache in (True, True, 'contours', 'contours'):
+                dl = DataLoader(base_dir, 1, True, cache=cache)
+                i2, mi2, mo2 = dl.next()
+                self.assertTrue(np.array_equal(i1, i2) and np.array_equal(mi1, mi2) and np.array_equal(mo1, mo2))
+                self.assertTrue(dl.next() is None)
+            self.assertTrue(path.isdir(path.join(base_dir, '.cache')))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_next_cache_moved(self):
+        """Test DataLoader.next() reading from the cache of a moved data directory """
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            base_dir = path.join(tmp_dir, 'test_data')
+            shutil.copytree('./test_data', base_dir)
+            i1, mi1, _ = DataLoader(base_dir, 4, cache='contours').next()
+
+            # samples are read from the new location
+            moved_dir = path.join(tmp_dir, 'moved_data')
+            shutil.move(base_dir, moved_dir)
+            i2, mi2, _ = DataLoader(moved_dir, 4, cache='contours').next()
+            self.assertTrue(np.array_equal(i1, i2) and np.array_equal(mi1, mi2))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_next_cache_inner_contours(self):
+        """Test DataLoader.next() reading samples with inner contours only from the cache """
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            base_dir = path.join(tmp_dir, 'test_data')
+            shutil.copytree('./test_data', base_dir)
+            masks = {np.sum(img): mask.copy() for i, mi, _ in iter(DataLoader(base_dir, 2).next, None)
+                     for img, mask in zip(i, mi)}
+
+            # the cache is built by the first loader and read by the second one, both give all 4 samples
+            for _ in range(2):
+                batches = list(iter(DataLoader(base_dir, 2, cache=True).next, None))
+                self.assertTrue(len(batches) == 2)
+                for i, mi, mo in batches:
+                    self.assertTrue(i.shape == (2,256,256) and mi.shape == (2,256,256) and mo is None)
+                    for img, mask in zip(i, mi):
+                        self.assertTrue(np.array_equal(masks[np.sum(img)], mask))
+                self.assertTrue(len(np.unique([np.sum(img) for i, _, _ in batches for img in i])) == 4)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_next_prefetch_thread(self):
+        """Test DataLoader.next() and DataLoader.reset() with a background thread """
+
+        dl = DataLoader('./test_data', 2, prefetch_thread=True, reuse_buffers=True)
+
+        # both minibatches are properly sized and in distinct arrays
+        i1, mi1, mo1 = dl.next()
+        i2, mi2, mo2 = dl.next()
+        self.assertTrue(i1.shape == (2,256,256) and mi1.shape == (2,256,256) and mo1 == None)
+        self.assertTrue(i2.shape == (2,256,256) and mi2.shape == (2,256,256) and mo2 == None)
+        self.assertTrue(i1 is not i2)
+        self.assertTrue(dl.next() is None)
+
+        # all 4 images were returned in the minibatches
+        n_unique_imgs = np.unique([np.sum(i1[0]), np.sum(i1[1]), np.sum(i2[0]), np.sum(i2[1])])
+        self.assertTrue(len(n_unique_imgs) == 4)
+
+        # a new epoch can be started in the middle of the previous one
+        dl.reset()
+        dl.next()
+        dl.reset()
+        self.assertTrue(len(list(iter(dl.next, None))) == 2)
+
+    def test_next_prefetch_thread_error(self):
+        """Test DataLoader.next() with the background thread failing """
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            base_dir = path.join(tmp_dir, 'test_data')
+            shutil.copytree('./test_data', base_dir)
+            dl = DataLoader(base_dir, 1, prefetch_thread=True)
+            os.remove(path.join(base_dir, 'contourfiles', 'folder1', 'i-contours', 'IM-0001-0179-icontour-manual.txt'))
+
+            # the error of the thread is raised instead of waiting for its minibatches forever
+            with self.assertRaises(FileNotFoundError):
+                while dl.next() is not None:
+                    pass
+            dl.reset()
+        finally:
+            shutil.rmtree(tmp_dir)
+
     def test_reset(self):
         """Test DataLoader.reset() """
 
@@ -1,6 +1,9 @@
 """Unit test for parsing methods"""
 
 import unittest
+import glob
+import os
+import tempfile
 import numpy as np
 from scipy import misc
 
@@ -28,6 +31,88 @@ class TestParsingMethods(unittest.TestCase):
             imgRGB[1][mask] = 0
             misc.imsave('test_data/merged{:d}.png'.format(id), imgRGB) #needs to be verified manually
 
+    def test_parse_dicom_file_rescale_out(self):
+        """Test parse_dicom_file() rescaling into given integer and float arrays"""
+
+        dcm = parsing.parse_dicom_file('test_data/dicoms/dicom1/68.dcm')['dcm']
+        dcm.RescaleSlope, dcm.RescaleIntercept = 0.5, 0.5
+        fd, filename = tempfile.mkstemp(suffix='.dcm')
+        os.close(fd)
+        try:
+            dcm.save_as(filename)
+            img = parsing.parse_dicom_file(filename)['pixel_data']
+            self.assertTrue(np.array_equal(img, dcm.pixel_array*0.5 + 0.5))
+
+            for dtype in (np.float32, np.int16):
+                out = np.empty(img.shape, dtype=dtype)
+                self.assertTrue(parsing.parse_dicom_file(filename, out=out)['pixel_data'] is out)
+                self.assertTrue(np.array_equal(out, img.astype(dtype)))
+        finally:
+            os.remove(filename)
+
+    def test_parse_dicom_file_invalid(self):
+        """Test parse_dicom_file() with truncated pixel data and an array of different shape"""
+
+        dcm = parsing.parse_dicom_file('test_data/dicoms/dicom1/68.dcm')['dcm']
+        with self.assertRaises(parsing.ShapeMismatchError):
+            parsing.parse_dicom_file('test_data/dicoms/dicom1/68.dcm', out=np.empty((2, 2)))
+
+        dcm.PixelData = dcm.PixelData[:1000]
+        fd, filename = tempfile.mkstemp(suffix='.dcm')
+        os.close(fd)
+        try:
+            dcm.save_as(filename)
+            self.assertTrue(parsing.parse_dicom_file(filename) is None)
+            self.assertTrue(parsing.parse_dicom_file(filename, out=np.empty((256, 256))) is None)
+        finally:
+            os.remove(filename)
+
+    def test_poly_to_mask_out(self):
+        """Test poly_to_mask() writing to a given array"""
+
+        polygon = [(1.0, 1.0), (6.0, 1.0), (6.0, 4.0), (1.0, 4.0)]
+        mask = parsing.poly_to_mask(polygon, 8, 6)
+        self.assertTrue(mask.dtype == np.bool_ and mask.shape == (6, 8) and np.sum(mask) > 0)
+
+        out = np.ones((2, 6, 8), dtype=np.bool_)
+        slot = out[1]
+        self.assertTrue(parsing.poly_to_mask(polygon, 8, 6, out=slot) is slot)
+        self.assertTrue(np.array_equal(out[1], mask) and np.all(out[0]))
+
+        strided = np.ones((8, 6), dtype=np.bool_).T
+        self.assertTrue(parsing.poly_to_mask(polygon, 8, 6, out=strided) is strided)
+        self.assertTrue(np.array_equal(strided, mask))
+
+    def test_poly_to_mask_writable(self):
+        """Test that the mask returned by poly_to_mask() can be modified"""
+
+        mask = parsing.poly_to_mask([(1.0, 1.0), (6.0, 1.0), (6.0, 4.0), (1.0, 4.0)], 8, 6)
+        self.assertTrue(mask.flags.writeable)
+        mask[0, 0] = True
+        self.assertTrue(mask[0, 0])
+
+    def test_fill_polygon(self):
+        """Test fill_polygon() on a rectangle"""
+
+        coords = np.array([(1.0, 1.0), (6.0, 1.0), (6.0, 4.0), (1.0, 4.0)])
+        out = np.ones((6, 8), dtype=np.bool_)
+        self.assertTrue(parsing.fill_polygon(coords, out) is out)
+
+        expected = np.zeros((6, 8), dtype=np.bool_)
+        expected[2:4, 2:6] = True # the outline is excluded, as by PIL
+        self.assertTrue(np.array_equal(out, expected))
+        self.assertTrue(np.array_equal(parsing.poly_to_mask(coords, 8, 6, fast=parsing.njit is not None), expected))
+
+    def test_fill_polygon_pil(self):
+        """Test that fill_polygon() rasterizes contours as PIL does"""
+
+        for filename in sorted(glob.glob('test_data/contourfiles/folder1/*/*.txt')):
+            coords_lst = parsing.parse_contour_file(filename)
+            mask = parsing.poly_to_mask(coords_lst, 256, 256)
+            out = parsing.fill_polygon(np.array(coords_lst), np.empty((256, 256), dtype=np.bool_))
+            self.assertTrue(np.sum(mask) > 0)
+            self.assertTrue(np.array_equal(out, mask))
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file